@@ -147,11 +147,15 @@ async fn handle_client_wsock(
                         if buf.len() + 1 < buf.capacity() {
                             buf.push(data);
                         } else {
-                            let msg = serde_json::to_string(&buf).unwrap();
-                            log::debug!("[NET] {addr}> Sending data: {msg}");
-                            if let Err(e) = outgoing.send(Message::from(
-                                msg.as_str(),
-                            )).await {
+                            // Packed little-endian packets, same layout as the TCP stream
+                            let mut msg = Vec::with_capacity(
+                                buf.len() * std::mem::size_of::<AccelData>(),
+                            );
+                            for data in buf.iter() {
+                                msg.extend_from_slice(&data.as_bytes());
+                            }
+                            log::debug!("[NET] {addr}> Sending {} bytes", msg.len());
+                            if let Err(e) = outgoing.send(Message::binary(msg)).await {
                                 log::error!("[NET] {addr}> Error sending data: {e}");
                                 break;
                             }
@@ -0,0 +1,100 @@
+# %%
+from pathlib import Path
+from queue import Queue
+from typing import Optional
+
+import pyqtgraph as pg
+from pyqtgraph.Qt import QtCore, QtWidgets
+
+from nc_thread import NcDataset
+from plot_utils import client_parser, plot_window, start_tcp_client
+from tcp_thread import SampleBatch, latest
+
+# %%
+WIN_WID = 800
+WIN_HEI = 600
+COLORS = ('r', 'g', 'b')
+
+
+def run(queue: Queue, winsize: int = 1000, compression: str = 'zstd', digits: Optional[int] = None, archive: Optional[str] = None, opengl: bool = False):
+    # Same display as app_tcp, drawn by pyqtgraph instead of matplotlib
+    pg.setConfigOptions(useOpenGL=opengl, antialias=False)
+    app = pg.mkQApp("Accelerometer Data")
+    win = QtWidgets.QWidget()
+    win.setWindowTitle("Accelerometer Data")
+    win.resize(WIN_WID, WIN_HEI)
+    layout = QtWidgets.QVBoxLayout(win)
+    curtime = QtWidgets.QLabel("Accelerometer Data: Waiting for data...")
+    curtime.setAlignment(QtCore.Qt.AlignmentFlag.AlignCenter)
+    layout.addWidget(curtime)
+    button = QtWidgets.QPushButton('Save')
+    layout.addWidget(button)
+    ncfile = NcDataset(Path.cwd() / 'data', compression=compression, digits=digits, archive=archive)
+
+    def on_save():
+        button.setText('Close' if ncfile.toggle() else 'Save')
+
+    button.clicked.connect(on_save)
+
+    plots = pg.GraphicsLayoutWidget()
+    layout.addWidget(plots, stretch=1)
+    curves = []
+    for i in range(2):
+        curves.append([])
+        for (j, title) in enumerate(('Acceleration', 'Jerk')):
+            plot: pg.PlotItem = plots.addPlot(row=i, col=j)
+            if i == 0:
+                plot.setTitle(title)
+            else:
+                plot.setLabel('bottom', 'Offset (ms)')
+            plot.setLabel('left', 'Acceleration (g)' if j == 0 else 'Jerk (g/s)')
+            plot.setXRange(-winsize, 0)
+            if j == 0:
+                plot.setYRange(-2, 2)
+            else:
+                plot.enableAutoRange(axis='y')
+            plot.setMouseEnabled(x=False, y=False)
+            items = []
+            for color in COLORS:
+                item = plot.plot(pen=color)
+                # Draw the min/max per pixel of the visible part only
+                item.setDownsampling(auto=True, method='peak')
+                item.setClipToView(True)
+                items.append(item)
+            curves[i].append(items)
+
+    def update():
+        snapshots = latest(queue)
+        if snapshots is None:
+            return
+        ncfile.update(snapshots)
+        for (row, (id, _, data)) in zip(curves, snapshots):
+            data: SampleBatch = data
+            if len(data) == 0:
+                print(f"ID {id}> No data available")
+                continue
+            now, window, tstamp = plot_window(data, winsize)
+            curtime.setText(f"Accelerometer Data: {now:.2f} s")
+            for (items, cols) in zip(row, (window.acc, window.jerk)):
+                for (item, col) in zip(items, cols):
+                    item.setData(tstamp, col)
+
+    timer = QtCore.QTimer()
+    timer.setInterval(100)
+    timer.timeout.connect(update)
+    timer.start()
+    win.show()
+    app.exec()
+    print("Done receiving data")
+    ncfile.close()
+
+
+# %%
+if __name__ == "__main__":
+    parser = client_parser("TCP Client for Accelerometer Data, plotted with pyqtgraph")
+    parser.add_argument(
+        '--opengl', action='store_true', help='Render the plots with OpenGL (needs PyOpenGL)'
+    )
+    args = parser.parse_args()
+    queue, winsize = start_tcp_client(args)
+    run(queue, winsize=winsize, compression=args.compression, digits=args.digits, archive=args.archive, opengl=args.opengl)
@@ -9,16 +9,15 @@ from matplotlib.animation import FuncAnimation
 from matplotlib.axes import Axes
 from matplotlib.gridspec import GridSpec
 import numpy as np
-import pandas as pd
 import matplotlib.pyplot as plt
-from collections import deque
 from netCDF4 import Dataset
 from datetime import datetime
 from matplotlib.widgets import Button
 import threading
 from queue import Queue, Empty
-from tcp_thread import TcpThread
+from tcp_thread import SampleBatch, latest
 from nc_thread import NcDataset
+from plot_utils import client_parser, minmax_downsample, plot_window, start_tcp_client, update_ylim
 import warnings
 
 # Ignore matplotlib warnings
@@ -28,30 +27,6 @@ matplotlib.use('QtAgg')  # Use TkAgg backend for interactive plotting
 # %%
 
 
-class DataBuffer:
-    def __init__(self, maxlen=2000):
-        # Ensure maxlen is a power of 2
-        maxlen = 1 << int(np.ceil(np.log2(maxlen)))
-        self._data = deque(maxlen=maxlen)
-
-    def append(self, item):
-        self._data.append(item)
-
-    def clear(self):
-        self._data.clear()
-
-    def __getitem__(self, index):
-        return self._data[index]
-
-    def __len__(self):
-        return len(self._data)
-
-    def to_dataframe(self, columns=None):
-        if columns is None:
-            columns = ['tstamp', 'x', 'y', 'z', 'dx', 'dy', 'dz']
-        return pd.DataFrame(list(self._data), columns=columns)
-
-
 class DataRate:
     def __init__(self, update_rate: float = 2.0):
         self.count = 0
@@ -85,7 +60,7 @@ FIG_WID = 800 / DPI
 FIG_HEI = 600 / DPI
 
 
-def run(queue: Queue, winsize: int = 1000):
+def run(queue: Queue, winsize: int = 1000, compression: str = 'zstd', digits: Optional[int] = None, archive: Optional[str] = None):
     plt.ioff()
     grid = GridSpec(4, 8, width_ratios=[1]*8, height_ratios=[
                     0.1, 0.1, 1, 1], left=0.065, bottom=0.065, wspace=0.5)
@@ -98,7 +73,7 @@ def run(queue: Queue, winsize: int = 1000):
     )
     button_ax = fig.add_subplot(grid[1, 3:5])
     # button_ax.set_axis_off()
-    ncfile = NcDataset(Path.cwd() / 'data', button_ax)
+    ncfile = NcDataset(Path.cwd() / 'data', button_ax, compression=compression, digits=digits, archive=archive)
     axs = []
     for i in range(2):
         axs.append([])
@@ -108,7 +83,11 @@ def run(queue: Queue, winsize: int = 1000):
                 ax = fig.add_subplot(grid[i+2, ar], sharex=axs[0][j])
             else:
                 ax = fig.add_subplot(grid[i+2, ar])
-            ax.autoscale(enable=True, axis='y')
+            # Acceleration has fixed limits, jerk is rescaled on demand
+            if j == 0:
+                ax.set_ylim(-2, 2)
+            else:
+                ax.set_ylim(-1, 1)
             axs[i].append(ax)
     axs = np.asarray(axs)
     for ax in axs[:-1, :].flatten():
@@ -152,7 +131,7 @@ def run(queue: Queue, winsize: int = 1000):
     )
     fig.text(
         0.9725, 0.5, "Jerk (g/s)", fontsize=12,
-        ha='center', va='center', rotation='vertical', animated=True
+        ha='center', va='center', rotation='vertical'
     )
 
     fig.show()
@@ -163,49 +142,41 @@ def run(queue: Queue, winsize: int = 1000):
 
     def update(frame):
         try:
-            dataframes = None
-            while True:
-                try:
-                    dataframes = queue.get_nowait()
-                except Empty:
-                    break
-            if dataframes is None:
+            snapshots = latest(queue)
+            if snapshots is None:
                 return artists
-            ncfile.update(dataframes)
-            for (llines, axm, (id, df)) in zip(lines, axs, dataframes):
-                df: pd.DataFrame = df
+            ncfile.update(snapshots)
+            redraw = False
+            for (llines, axm, (id, _, data)) in zip(lines, axs, snapshots):
                 id: int = id
-                if df.empty:
+                data: SampleBatch = data
+                if len(data) == 0:
                     print(f"ID {id}> No data available")
                     continue
-                now = df['tstamp'].iloc[-1]
-                # Show last second of data
-                sel = df['tstamp'] > (now - winsize * 1e-3)
-                tstamp = df['tstamp'][sel]  # Convert to milliseconds
+                now, window, tstamp = plot_window(data, winsize)
                 curtime.set_text(f"Accelerometer Data: {now:.2f} s")
-                # tstamp = tstamp * 1e-6  # Convert to seconds
-                tstamp -= tstamp.iloc[-1]
-                tstamp *= 1e3  # Convert to milliseconds for plotting
                 for aid, (lline, ax) in enumerate(zip(llines, axm)):
                     lline: list = lline
                     ax: Axes = ax
-                    if aid % 2 == 0:
-                        lline[0].set_data(tstamp, df['x'][sel])
-                        lline[1].set_data(tstamp, df['y'][sel])
-                        lline[2].set_data(tstamp, df['z'][sel])
-                        ax.set_ylim(-2, 2)
-                    else:
-                        lline[0].set_data(tstamp, df['dx'][sel])
-                        lline[1].set_data(tstamp, df['dy'][sel])
-                        lline[2].set_data(tstamp, df['dz'][sel])
-                    ax.relim()
-                    ax.autoscale_view()
+                    cols = window.acc if aid % 2 == 0 else window.jerk
+                    # No point drawing more points than there are pixels
+                    tdata, ydata = minmax_downsample(
+                        tstamp, np.stack(cols), int(ax.bbox.width))
+                    for line, y in zip(lline, ydata):
+                        line.set_data(tdata, y)
+                    if aid % 2 != 0:
+                        if update_ylim(ax, np.nanmin(ydata), np.nanmax(ydata)):
+                            redraw = True
+            if redraw:
+                # Redraw the static parts, the animation then re-caches
+                # the backgrounds of the axes whose limits changed
+                fig.canvas.draw()
         except Empty:
             sleep(0.01)
         return artists
 
     animation = FuncAnimation(
-        fig, update, blit=False,
+        fig, update, blit=True,
         repeat=False, save_count=100,
         interval=100
     )
@@ -218,28 +189,6 @@ def run(queue: Queue, winsize: int = 1000):
 
 # %%
 if __name__ == "__main__":
-    import argparse
-    parser = argparse.ArgumentParser(
-        description="TCP Client for Accelerometer Data")
-    parser.add_argument(
-        'host', type=str, help='Host address of the TCP server', default='localhost', nargs='?')
-    parser.add_argument(
-        'port', type=int, help='Port number of the TCP server', default=14389, nargs='?')
-    parser.add_argument(
-        '--window', type=int, default=1, help='Window size for data display in seconds'
-    )
-    args = parser.parse_args()
-    winsize = args.window*1000
-    if winsize < 1000:
-        print(f"Window size {winsize} ms is too small, setting to 1000 ms")
-        winsize = 1000
-    elif winsize > 10000:
-        print(f"Window size {winsize} ms is too large, setting to 10000 ms")
-        winsize = 10000
-    queue = Queue()
-    thread = TcpThread(args.host, args.port, queue, datasize=winsize)
-    thread.daemon = True  # Ensure the thread exits when the main program exits
-    thread.start()
-    print(
-        f"Starting TCP client thread for {args.host}:{args.port} with window size {winsize} ms")
-    run(queue, winsize=winsize)
+    args = client_parser("TCP Client for Accelerometer Data").parse_args()
+    queue, winsize = start_tcp_client(args)
+    run(queue, winsize=winsize, compression=args.compression, digits=args.digits, archive=args.archive)
@@ -1,46 +1,26 @@
 # %%
-from collections import deque
 from datetime import datetime
-from netCDF4 import Dataset
-from websockets.sync.client import connect
-from time import perf_counter_ns
-from typing import Dict
+from pathlib import Path
+from queue import Queue
+from typing import Dict, Optional
 from matplotlib.axes import Axes
 from matplotlib.gridspec import GridSpec
 import numpy as np
-import pandas as pd
 import matplotlib.pyplot as plt
-import json
+from nc_thread import NcThread, NotifiableDeque
+from plot_utils import client_parser, plot_window, update_ylim
+from tcp_thread import SampleBatch, latest
+from wsock_thread import WsockThread
 
 import matplotlib
 matplotlib.use('QtAgg')  # Use TkAgg backend for interactive plotting
 # %%
-class DataBuffer:
-    def __init__(self, maxlen=2000):
-        self._data = deque(maxlen=maxlen)
-
-    def append(self, item):
-        self._data.append(item)
-
-    def clear(self):
-        self._data.clear()
-
-    def __getitem__(self, index):
-        return self._data[index]
-    
-    def __len__(self):
-        return len(self._data)
-    
-    def to_dataframe(self, columns=None):
-        if columns is None:
-            columns = ['tstamp', 'x', 'y', 'z', 'dx', 'dy', 'dz']
-        return pd.DataFrame(list(self._data), columns=columns)
-# %%
 DPI = 72
 FIG_WID = 800 / DPI
 FIG_HEI = 600 / DPI
+WINSIZE = 1000  # Shown window in ms
 
-def run(addr: str, port: int):
+def run(queue: Queue, compression: str = 'zstd', digits: Optional[int] = None, archive: Optional[str] = None):
     plt.ioff()
     grid = GridSpec(2, 2, width_ratios=[1, 1], height_ratios=[1, 1], left=0.065, bottom=0.065)
     fig = plt.figure(figsize=(FIG_WID, FIG_HEI), dpi=DPI)
@@ -65,182 +45,113 @@ def run(addr: str, port: int):
         ax.set_title(title, fontsize=10, fontweight='bold')
     for ax in axs[-1, :].flatten():
         ax: Axes = ax
-        ax.set_xlim(-1000, 0)
+        ax.set_xlim(-WINSIZE, 0)
         ax.set_xlabel('Offset (ms)', fontsize=10)
 
 
     fig.suptitle("Accelerometer Data", fontsize=12, fontweight='bold')
     # fig.tight_layout()
-    ids = []
-    last_update = None
     fig.text(0.025, 0.5, "Acceleration (g)", fontsize=12, ha='center', va='center', rotation='vertical')
     fig.text(0.5, 0.025, "Time (ms)", fontsize=12, ha='center', va='center')
     fig.text(0.9725, 0.5, "Jerk (g/s)", fontsize=12, ha='center', va='center', rotation='vertical')
 
-    fig.show()
-    fignum = fig.number
-    # %%
-    try:
-        client = connect(f"ws://{addr}:{port}")
-    except Exception as e:
-        print(f"Failed to connect to {addr}:{port} - {e}")
-        return
+    # Persistent line artists, one row of axes per id. They are animated so
+    # full draws leave them out of the cached background.
+    lines = []
+    for axm in axs:
+        lines.append([])
+        for aid, ax in enumerate(axm):
+            labels = ('X', 'Y', 'Z') if aid == 0 else ('dX', 'dY', 'dZ')
+            lines[-1].append([
+                ax.plot([], [], label=label, color=color, animated=True)[0]
+                for (label, color) in zip(labels, ('red', 'green', 'blue'))
+            ])
+            if aid == 0:
+                ax.set_ylim(-2, 2)
+            else:
+                ax.set_ylim(-1, 1)
+    flatlines = [line for llines in lines for lline in llines for line in lline]
+    background = None
+
+    def on_draw(event):
+        # Cache the static parts of the figure after every full draw
+        nonlocal background
+        background = fig.canvas.copy_from_bbox(fig.bbox)
+        for line in flatlines:
+            fig.draw_artist(line)
 
-    # Use DataBuffer for efficient data handling
-    datasets: Dict[int, DataBuffer] = dict()
-    packets: Dict[int, int] = dict()  # For debugging purposes
-    ncfile = Dataset(f"{datetime.now():%Y%m%d_%H%M%S}.nc",
-                     'w', format='NETCDF4')
+    def on_resize(event):
+        # The cached background no longer fits, wait for the next full draw
+        nonlocal background
+        background = None
 
-    while True:
-        try:
-            data = client.recv()
-            if isinstance(data, str):
-                try:
-                    datas = json.loads(data)
-                except json.JSONDecodeError:
-                    print(f"Received non-JSON data: {data}")
-                    continue
-                try:
-                    for data in datas:
-                        try:
-                            id = data['idx']
-                            gap = data['gap']*1e-6  # Convert to seconds
-                            x = data['x']
-                            y = data['y']
-                            z = data['z']
-                        except KeyError as e:
-                            print(f"Missing key in data: {e}, {data}")
-                            continue
-                        if id not in datasets:
-                            print(f"Creating new DataBuffer: {id}, {gap}, {x}, {y}, {z}")
-                            ids.append(id)
-                            datasets[id] = DataBuffer(maxlen=2000)
-                            datasets[id].append((gap, x, y, z, np.nan, np.nan, np.nan))
-                            packets[id] = 1
-                        else:
-                            tstamp, x0, y0, z0, _, _, _ = datasets[id][-1]
-                            tstamp += gap
-                            dx = (x - x0) / gap
-                            dy = (y - y0) / gap
-                            dz = (z - z0) / gap
-                            datasets[id].append((tstamp, x, y, z, dx, dy, dz))
-                            packets[id] += 1
-                except Exception as e:
-                    print(f"Error processing data: {e}, {datas}")
-                    continue
-            
-            if last_update is None:
-                last_update = perf_counter_ns()
-            elif perf_counter_ns() - last_update > 100e6:  # Update every 16 ms
-                last_update = perf_counter_ns()
-                for (axm, id) in zip(axs, ids):
-                    if id in datasets:
-                        ds = datasets[id]
-                        df = ds.to_dataframe()
-                        if df.empty:
-                            print(f"ID {id}> No data available")
-                            continue
-                        if str(id) not in ncfile.groups.keys():
-                            print(f"Creating NetCDF group for ID {id}")
-                            group = ncfile.createGroup(str(id))
-                            group.createDimension('tstamp', None)
-                            nctime = group.createVariable('tstamp', 'f8', ('tstamp',), compression='zlib')
-                            ncx = group.createVariable('x', 'f4', ('tstamp',), compression='zlib')
-                            ncy = group.createVariable('y', 'f4', ('tstamp',), compression='zlib')
-                            ncz = group.createVariable('z', 'f4', ('tstamp',), compression='zlib')
-                            nctime[:] = df['tstamp'].values  # type: ignore
-                            ncx[:] = df['x'].values  # type: ignore
-                            ncy[:] = df['y'].values  # type: ignore
-                            ncz[:] = df['z'].values  # type: ignore
-                        else:
-                            group = ncfile.groups[str(id)]
-                            nctime = group.variables['tstamp']
-                            ncx = group.variables['x']
-                            ncy = group.variables['y']
-                            ncz = group.variables['z']
-                            dlen = len(nctime)
-                            nctime[dlen:] = df['tstamp'].values  # type: ignore
-                            ncx[dlen:] = df['x'].values  # type: ignore
-                            ncy[dlen:] = df['y'].values  # type: ignore
-                            ncz[dlen:] = df['z'].values  # type: ignore
-                        now = df['tstamp'].iloc[-1]
-                        # Show last second of data
-                        sel = df['tstamp'] > (now - 1)
-                        tstamp = df['tstamp'][sel]  # Convert to milliseconds
-                        tstamp -= tstamp.iloc[-1]
-                        tstamp *= 1e3  # Convert to milliseconds for plotting
-                        ymin_x = np.nanmin(df['x'][sel])
-                        ymax_x = np.nanmax(df['x'][sel])
-                        ymin_y = np.nanmin(df['y'][sel])
-                        ymax_y = np.nanmax(df['y'][sel])
-                        ymin_z = np.nanmin(df['z'][sel])
-                        ymax_z = np.nanmax(df['z'][sel])
-                        ymin_dx = np.nanmin(df['dx'][sel])
-                        ymax_dx = np.nanmax(df['dx'][sel])
-                        ymin_dy = np.nanmin(df['dy'][sel])
-                        ymax_dy = np.nanmax(df['dy'][sel])
-                        ymin_dz = np.nanmin(df['dz'][sel])
-                        ymax_dz = np.nanmax(df['dz'][sel])
-                        ymin = np.nanmin((ymin_x, ymin_y, ymin_z))
-                        ymax = np.nanmax((ymax_x, ymax_y, ymax_z))
-                        dymin = np.nanmin((ymin_dx, ymin_dy, ymin_dz))
-                        dymax = np.nanmax((ymax_dx, ymax_dy, ymax_dz))
-                        if np.isnan(ymin):
-                            ymin = -1
-                        if np.isnan(ymax):
-                            ymax = 1
-                        if np.isnan(dymin):
-                            dymin = -1
-                        if np.isnan(dymax):
-                            dymax = 1
-                        # print(f"ID {id}> {len(tstamp)} points, time range {tstamp.iloc[0]} to {tstamp.iloc[-1]} ms")
-                        # print(f'ID {id}> Y-axis limits: Y: ({ymin}, {ymax}), dY: ({dymin}, {dymax})')
-                        for aid, ax in enumerate(axm):
-                            ax.clear()
-                            if aid == 0:
-                                ax.plot(tstamp, df['x'][sel],
-                                        label='X', color='red')
-                                ax.plot(tstamp, df['y'][sel],
-                                        label='Y', color='green')
-                                ax.plot(tstamp, df['z'][sel],
-                                        label='Z', color='blue')
-                                # ax.set_ylim(ymin, ymax)
-                                ax.set_ylim(-2, 2)
-                            elif aid == 1:
-                                ax.plot(tstamp, df['dx'][sel],
-                                        label='dX', color='red')
-                                ax.plot(tstamp, df['dy'][sel],
-                                        label='dY', color='green')
-                                ax.plot(tstamp, df['dz'][sel],
-                                        label='dZ', color='blue')
-                                ax.set_ylim(dymin, dymax)
-                            ax.set_xlim(-1000, 0)
+    fig.canvas.mpl_connect('draw_event', on_draw)
+    fig.canvas.mpl_connect('resize_event', on_resize)
 
-                fig.canvas.draw()
-                fig.canvas.flush_events()
+    # NetCDF writes happen on a separate thread to keep the plot responsive
+    ncqueue = NotifiableDeque()
+    queued: Dict[int, int] = dict()  # Samples per id already handed to the writer
+    ncthread = NcThread(
+        ncqueue, Path(f"{datetime.now():%Y%m%d_%H%M%S}.nc"), compression=compression, digits=digits, archive=archive)
+    ncthread.start()
+
+    # %%
+    def update():
+        # Runs on the GUI event loop, the receiving happens on WsockThread
+        snapshots = latest(queue)
+        if snapshots is None:
+            return
+        tails = []
+        redraw = False
+        for (axm, llines, (id, total, snap)) in zip(axs, lines, snapshots):
+            snap: SampleBatch = snap
+            # Only hand the writer what it has not seen yet
+            new = min(total - queued.get(id, 0), len(snap))
+            if new > 0:
+                tails.append((id, total, snap[-new:]))
+                queued[id] = total
+            (_, window, tstamp) = plot_window(snap, WINSIZE)
+            acc = window.acc
+            # Stacked so the limits take one pass each
+            jerk = np.stack(window.jerk)
+            for k in range(3):
+                llines[0][k].set_data(tstamp, acc[k])
+                llines[1][k].set_data(tstamp, jerk[k])
+            if update_ylim(axm[1], np.nanmin(jerk), np.nanmax(jerk)):
+                redraw = True
 
-        except Exception as e:
-            print(f"Error: {e}")
-            client.close()
-            break
-        except KeyboardInterrupt:
-            print("Interrupted by user")
-            client.close()
-            plt.close(fig)
-            break
+        if len(tails):
+            ncqueue.append(tails)
+        if redraw or background is None:
+            # Limits changed, redraw everything once the event loop is idle,
+            # on_draw then re-caches the background and draws the lines
+            fig.canvas.draw_idle()
+        else:
+            fig.canvas.restore_region(background)
+            for line in flatlines:
+                fig.draw_artist(line)
+            # Only the plot areas change, push just those to the screen
+            for ax in axs.flat:
+                fig.canvas.blit(ax.bbox)
 
-        if plt.fignum_exists(fignum) is False:
-            print("Figure closed, exiting loop")
-            client.close()
-            break
+    # Redraw on a timer, independent of how fast data arrives
+    timer = fig.canvas.new_timer(interval=100)
+    timer.add_callback(update)
+    timer.start()
+    plt.show()
+    timer.stop()
     print("Done receiving data")
+    # Let the writer drain the pending data before closing the file
+    ncqueue.shutdown()
+    ncthread.join()
 
 # %%
 if __name__ == "__main__":
-    import argparse
-    parser = argparse.ArgumentParser(description="WebSocket Client for Accelerometer Data")
-    parser.add_argument('host', type=str, help='Host address of the WebSocket server', default='localhost', nargs='?')
-    parser.add_argument('port', type=int, help='Port number of the WebSocket server', default=14389, nargs='?')
+    parser = client_parser("WebSocket Client for Accelerometer Data", server='WebSocket', window=False)
     args = parser.parse_args()
-    run(args.host, args.port)
\ No newline at end of file
+    queue = Queue(maxsize=4)  # Older snapshots are dropped when full
+    thread = WsockThread(args.host, args.port, queue, datasize=2000)
+    thread.daemon = True  # Ensure the thread exits when the main program exits
+    thread.start()
+    print(f"Starting WebSocket client thread for {args.host}:{args.port}")
+    run(queue, compression=args.compression, digits=args.digits, archive=args.archive)
@@ -1,49 +1,181 @@
 from __future__ import annotations
 
+from collections import deque
 from datetime import datetime
 from pathlib import Path
-from queue import Queue, ShutDown
-from threading import Thread
-from typing import List, Optional, Tuple
+from queue import ShutDown
+from threading import Event, Lock, Thread
+from typing import Dict, List, Optional, Tuple
 
 from matplotlib.axes import Axes
 from matplotlib.widgets import Button
-from netCDF4 import Dataset
-import pandas as pd
+import netCDF4
+from netCDF4 import Dataset, Variable
+import numpy as np
+
+from tcp_thread import SampleBatch
+
+# Compression filters selectable for the saved variables, and whether the
+# underlying netCDF-C library was built with them
+COMPRESSIONS = {
+    'none': True,
+    'zlib': True,
+    'zstd': getattr(netCDF4, '__has_zstandard_support__', False),
+    'blosc_lz4': getattr(netCDF4, '__has_blosc_support__', False),
+    'blosc_zstd': getattr(netCDF4, '__has_blosc_support__', False),
+}
+# Extra filter arguments per compression. blosc_lz4 gets blosc's
+# bitshuffle, blosc_zstd keeps blosc's default byte shuffle. netCDF4 only
+# applies the HDF5 shuffle filter with zlib, so plain zstd is unshuffled.
+FILTER_ARGS = {
+    'blosc_lz4': {'blosc_shuffle': 2},
+}
+# Lossy quantization of the samples to a number of significant digits
+QUANTIZATION = bool(getattr(netCDF4, '__has_quantization_support__', False))
+CHUNK_SIZE = 16384  # Samples per chunk along the unlimited dimension
+# Per variable HDF5 chunk cache: a few chunks, evicting fully written ones
+# first since the data is only ever appended
+CHUNK_CACHE = dict(size=4 * CHUNK_SIZE * 8, nelems=37, preemption=1.0)
+SYNC_INTERVAL = 50  # Number of queued batches between flushes to disk
+COPY_SIZE = 64 * CHUNK_SIZE  # Samples per read when recompressing a file
+NC_COLUMNS = ('tstamp', 'x', 'y', 'z')  # SampleBatch columns saved per ID
+
+
+def compression_args(compression: str, complevel: int = 1) -> dict:
+    # Keyword arguments for createVariable, falling back to zlib when the
+    # requested filter is unavailable
+    if not COMPRESSIONS.get(compression, False):
+        print(f'Compression {compression} not available, using zlib')
+        compression = 'zlib'
+    args = {'chunksizes': (CHUNK_SIZE,)}
+    if compression != 'none':
+        args['compression'] = compression
+        args['complevel'] = complevel
+        args.update(FILTER_ARGS.get(compression, {}))
+    return args
+
+
+def sample_args(varargs: dict, digits: Optional[int] = None) -> dict:
+    # Arguments for the x, y, z samples, the timestamps stay exact
+    args = dict(varargs)
+    if digits is not None:
+        if QUANTIZATION:
+            args['significant_digits'] = digits
+        else:
+            print('Quantization not available, saving full precision')
+    return args
+
+
+def recompress(fname: Path, compression: str, digits: Optional[int] = None):
+    # Rewrite a saved file with another compression, e.g. one recorded
+    # uncompressed so the writer keeps up with the data
+    tmp = fname.with_name(fname.stem + '.tmp' + fname.suffix)
+    varargs = compression_args(compression)
+    sampleargs = sample_args(varargs, digits)
+    with Dataset(fname, 'r') as src, Dataset(tmp, 'w', format='NETCDF4') as dst:
+        src.set_auto_mask(False)
+        for (gname, sgroup) in src.groups.items():
+            dgroup = dst.createGroup(gname)
+            dgroup.createDimension('tstamp', None)
+            for (vname, svar) in sgroup.variables.items():
+                dvar = dgroup.createVariable(
+                    vname, svar.datatype, svar.dimensions,
+                    **(varargs if vname == 'tstamp' else sampleargs))
+                for start in range(0, len(svar), COPY_SIZE):
+                    dvar[start:] = svar[start:start + COPY_SIZE]
+    tmp.replace(fname)
+
+
+# Many producers, one consumer that takes everything queued at once. A
+# plain lock around each append is cheaper than the condition variables
+# of queue.Queue, and the consumer wakes once per burst instead of per item.
+class NotifiableDeque:
+    def __init__(self):
+        # Unbounded, a full queue would silently drop unsaved samples
+        self._d = deque()
+        self._lock = Lock()
+        self._evt = Event()
+        self._shutdown = False
+
+    def append(self, item):
+        with self._lock:
+            if self._shutdown:
+                raise ShutDown
+            self._d.append(item)
+            self._evt.set()
+
+    def drain(self) -> deque:
+        # Block until something is queued, then return all of it. Raises
+        # ShutDown once shut down and empty, like queue.Queue.get().
+        self._evt.wait()
+        with self._lock:
+            items = self._d
+            if len(items) == 0 and self._shutdown:
+                raise ShutDown
+            self._d = deque()
+            if not self._shutdown:
+                self._evt.clear()
+            return items
+
+    def shutdown(self, immediate: bool = False):
+        # Wake the consumer, with immediate pending items are discarded
+        with self._lock:
+            self._shutdown = True
+            if immediate:
+                self._d.clear()
+            self._evt.set()
 
 
 class NcDataset:
-    def __init__(self, dir: Path, axis: Axes):
-        self.button = Button(axis, 'Save')
-        self.button.on_clicked(self.callback)
+    def __init__(self, dir: Path, axis: Optional[Axes] = None, compression: str = 'zstd', digits: Optional[int] = None, archive: Optional[str] = None):
+        # Without an axis no Save button is drawn, call toggle() instead
+        self.button: Optional[Button] = None
+        if axis is not None:
+            self.button = Button(axis, 'Save')
+            self.button.on_clicked(self.callback)
         self._dir = dir
         if not self._dir.exists():
             self._dir.mkdir(parents=True, exist_ok=True)
-        self.queue: Optional[Queue] = None
+        self.queue: Optional[NotifiableDeque] = None
         self.ncthread: Optional[NcThread] = None
+        # Stopped writers, possibly still recompressing their files
+        self._stopped: List[NcThread] = []
+        self.compression = compression
+        self.digits = digits
+        self.archive = archive
 
     def get_artist(self):
         return self.button
 
     def callback(self, evt):
         # print(f"Button clicked, {self.queue is None}, {self.ncthread is None}")
+        saving = self.toggle()
+        if self.button is not None:
+            self.button.label.set_text('Close' if saving else 'Save')
+
+    def toggle(self) -> bool:
+        # Start or stop saving, returns whether a file is now open
         if self.queue is None:
-            self.button.label.set_text('Close')
-            self.queue = Queue()
+            self.queue = NotifiableDeque()
             self.ncthread = NcThread(
-                self.queue, self._dir / f"data_{datetime.now().strftime('%Y%m%d_%H%M%S')}.nc")
+                self.queue, self._dir / f"data_{datetime.now().strftime('%Y%m%d_%H%M%S')}.nc",
+                compression=self.compression, digits=self.digits, archive=self.archive)
             self.ncthread.start()
+            return True
         else:
-            self.button.label.set_text('Save')
             self.queue.shutdown(immediate=True)
             self.queue = None
             if self.ncthread is not None:
-                self.ncthread.join()
+                # Not joined here, with archive set the writer goes on to
+                # recompress the file and that would block the GUI
+                self._stopped = [t for t in self._stopped if t.is_alive()]
+                self._stopped.append(self.ncthread)
                 self.ncthread = None
+            return False
 
-    def update(self, data: List[Tuple[int, pd.DataFrame]]):
+    def update(self, data: List[Tuple[int, int, SampleBatch]]):
         if self.queue is not None:
-            self.queue.put(data)
+            self.queue.append(data)
         else:
             pass
 
@@ -52,59 +184,99 @@ class NcDataset:
             self.queue.shutdown(immediate=True)
             self.queue = None
         if self.ncthread is not None:
-            self.ncthread.join()
+            self._stopped.append(self.ncthread)
             self.ncthread = None
+        if len(self._stopped) > 0:
+            # Wait for every writer to finish closing and recompressing
+            for ncthread in self._stopped:
+                ncthread.join()
+            self._stopped.clear()
             print("NetCDF file closed")
         else:
             print("No NetCDF file to close")
 
 
 class NcThread(Thread):
-    def __init__(self, queue: Queue, name: Path):
+    def __init__(self, queue: NotifiableDeque, name: Path, compression: str = 'zstd', digits: Optional[int] = None, archive: Optional[str] = None):
         super().__init__()
         self.queue = queue
         self.fname = name
         self.dataset: Optional[Dataset] = None
+        self.varargs = compression_args(compression)
+        self.sampleargs = sample_args(self.varargs, digits)
+        self.digits = digits
+        # Compression to rewrite the file with once recording stops
+        self.archive = archive
+        # Number of samples per id covered by what has been written so far
+        self._written: Dict[int, int] = dict()
+        # (tstamp, x, y, z) variables of the group for each id
+        self._vars: Dict[int, Tuple[Variable, ...]] = dict()
+        # Length of the variables of each id, so appends don't query the file
+        self._length: Dict[int, int] = dict()
+
+    def _create(self, id: int) -> Tuple[Variable, ...]:
+        print(f'\tCreating NetCDF group for ID {id}')
+        group = self.dataset.createGroup(str(id))  # type: ignore
+        group.createDimension('tstamp', None)
+        ncvars = (group.createVariable('tstamp', 'f8', ('tstamp',), **self.varargs),) + tuple(
+            group.createVariable(name, 'f4', ('tstamp',), **self.sampleargs)
+            for name in NC_COLUMNS[1:]
+        )
+        for var in ncvars:
+            var.set_var_chunk_cache(**CHUNK_CACHE)
+        # Leave define mode once, nothing about the group changes after this
+        self.dataset.sync()  # type: ignore
+        return ncvars
 
     def run(self):
         # Implement the thread's activity here
         if self.dataset is None:
             self.dataset = Dataset(self.fname, 'w', format='NETCDF4')
+            self.dataset.set_auto_mask(False)
         print(f"NetCDF file {self.fname} opened")
+        batches = 0
         while True:
+            # Take everything queued at once, so each variable gets a
+            # single append per wakeup instead of one per batch
             try:
-                data = self.queue.get()
+                items = self.queue.drain()
             except ShutDown:
                 break
-            for (id, df) in data:
+            pending: Dict[int, List[SampleBatch]] = dict()
+            for (id, total, snap) in (entry for data in items for entry in data):
                 id: int = id
-                df: pd.DataFrame = df
-                if str(id) not in self.dataset.groups.keys():
-                    print(f'\tCreating NetCDF group for ID {id}')
-                    group = self.dataset.createGroup(str(id))
-                    group.createDimension('tstamp', None)
-                    nctime = group.createVariable(
-                        'tstamp', 'f8', ('tstamp',), compression='zlib')
-                    ncx = group.createVariable(
-                        'x', 'f4', ('tstamp',), compression='zlib')
-                    ncy = group.createVariable(
-                        'y', 'f4', ('tstamp',), compression='zlib')
-                    ncz = group.createVariable(
-                        'z', 'f4', ('tstamp',), compression='zlib')
-                    nctime[:] = df['tstamp'].values  # type: ignore
-                    ncx[:] = df['x'].values  # type: ignore
-                    ncy[:] = df['y'].values  # type: ignore
-                    ncz[:] = df['z'].values  # type: ignore
-                else:
-                    group = self.dataset.groups[str(id)]
-                    nctime = group.variables['tstamp']
-                    ncx = group.variables['x']
-                    ncy = group.variables['y']
-                    ncz = group.variables['z']
-                    dlen = len(nctime)
-                    nctime[dlen:] = df['tstamp'].values  # type: ignore
-                    ncx[dlen:] = df['x'].values  # type: ignore
-                    ncy[dlen:] = df['y'].values  # type: ignore
-                    ncz[dlen:] = df['z'].values  # type: ignore
+                snap: SampleBatch = snap
+                # Snapshots overlap, only write what arrived since the last one
+                written = self._written.get(id)
+                start = 0
+                if written is not None:
+                    start = len(snap) - (total - written)
+                    if start < 0:
+                        print(f'\tID {id}> {-start} samples not saved, snapshots too far apart')
+                        start = 0
+                self._written[id] = total
+                if start >= len(snap):
+                    continue
+                pending.setdefault(id, []).append(snap[start:])
+            for (id, parts) in pending.items():
+                ncvars = self._vars.get(id)
+                if ncvars is None:
+                    ncvars = self._vars[id] = self._create(id)
+                dlen = self._length.get(id, 0)
+                self._length[id] = dlen + sum(len(p) for p in parts)
+                # Only the saved columns are joined, the jerk is not written
+                for (ncvar, col) in zip(ncvars, NC_COLUMNS):
+                    if len(parts) == 1:
+                        ncvar[dlen:] = getattr(parts[0], col)
+                    else:
+                        ncvar[dlen:] = np.concatenate([getattr(p, col) for p in parts])
+            batches += len(items)
+            if batches >= SYNC_INTERVAL:
+                batches = 0
+                self.dataset.sync()
         self.dataset.close()
         print(f"NetCDF file {self.fname} closed")
+        if self.archive is not None:
+            print(f"Recompressing {self.fname} with {self.archive}")
+            recompress(self.fname, self.archive, self.digits)
+            print(f"NetCDF file {self.fname} recompressed")
@@ -5,6 +5,8 @@ import numpy as np
 # %%
 def plot_nc(filename):
     ncfile = Dataset(filename, 'r')
+    # Plain arrays, the masked array wrapping costs a copy per variable
+    ncfile.set_auto_mask(False)
     glen = len(ncfile.groups)
     plt.ion()
     fig, axs = plt.subplots(glen, 1, dpi = 150)
@@ -14,14 +16,11 @@ def plot_nc(filename):
         print(f"Plotting group: {gname}")
         group = ncfile.groups[gname]
         tstamp = group.variables['tstamp'][:]
-        arg = np.argsort(tstamp)
-        tstamp = tstamp[arg]
-        x = group.variables['x'][:]
-        x = x[arg]
-        y = group.variables['y'][:]
-        y = y[arg]
-        z = group.variables['z'][:]
-        z = z[arg]
+        (x, y, z) = (group.variables[c][:] for c in ('x', 'y', 'z'))
+        # Files are written in time order, only sort when that is not so
+        if np.any(tstamp[1:] < tstamp[:-1]):
+            arg = np.argsort(tstamp, kind='stable')
+            (tstamp, x, y, z) = (v.take(arg) for v in (tstamp, x, y, z))
 
         ax.plot(tstamp, x, label='X', color='blue')
         ax.plot(tstamp, y, label='Y', color='green')
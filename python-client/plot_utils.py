@@ -0,0 +1,106 @@
+from __future__ import annotations
+
+import argparse
+from queue import Queue
+from typing import Tuple
+
+from matplotlib.axes import Axes
+import numpy as np
+
+from nc_thread import COMPRESSIONS
+from tcp_thread import SampleBatch, TcpThread
+
+YLIM_TOL = 0.1  # Fraction of the span the y-limits may drift before rescaling
+
+
+def update_ylim(ax: Axes, ymin: float, ymax: float) -> bool:
+    # Changing the limits invalidates the blit background, so only do it
+    # when the data range moved noticeably. Returns True if changed.
+    if np.isnan(ymin):
+        ymin = -1
+    if np.isnan(ymax):
+        ymax = 1
+    if not ymax > ymin:
+        ymin, ymax = ymin - 1, ymax + 1
+    cmin, cmax = ax.get_ylim()
+    tol = YLIM_TOL * (cmax - cmin)
+    if abs(ymin - cmin) > tol or abs(ymax - cmax) > tol:
+        ax.set_ylim(ymin, ymax)
+        return True
+    return False
+
+
+def minmax_downsample(t: np.ndarray, ys: np.ndarray, nbins: int):
+    # Reduce the lines in ys (one per row) to the min and max of nbins
+    # equal bins, which looks identical at a resolution of nbins pixels
+    n = len(t)
+    # Nothing to bin into for a collapsed axes, e.g. a zero width window
+    if nbins < 1 or n <= 2 * nbins:
+        return t, ys
+    idx = np.linspace(0, n, nbins, endpoint=False).astype(np.intp)
+    last = np.append(idx[1:], n) - 1
+    out_t = np.stack((t[idx], t[last]), axis=-1).reshape(-1)
+    # fmin/fmax skip NaNs, e.g. the undefined first derivative
+    out_y = np.stack((
+        np.fmin.reduceat(ys, idx, axis=-1),
+        np.fmax.reduceat(ys, idx, axis=-1),
+    ), axis=-1).reshape(ys.shape[0], -1)
+    return out_t, out_y
+
+
+def plot_window(data: SampleBatch, winsize: int) -> Tuple[float, SampleBatch, np.ndarray]:
+    # The last winsize ms of a non-empty snapshot, with its newest timestamp
+    # and the offsets (ms) to it
+    tstamp = data.tstamp
+    now = tstamp[-1]
+    # Timestamps are monotonic, so the window is a contiguous tail
+    start = np.searchsorted(tstamp, now - winsize * 1e-3, side='right')
+    window = data[start:]
+    offset = window.tstamp - now
+    offset *= 1e3  # To milliseconds in place, shared by all lines
+    return now, window, offset
+
+
+def client_parser(description: str, server: str = 'TCP', window: bool = True) -> argparse.ArgumentParser:
+    # Command line options shared by the clients
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        'host', type=str, help=f'Host address of the {server} server', default='localhost', nargs='?')
+    parser.add_argument(
+        'port', type=int, help=f'Port number of the {server} server', default=14389, nargs='?')
+    if window:
+        parser.add_argument(
+            '--window', type=int, default=1, help='Window size for data display in seconds'
+        )
+    parser.add_argument(
+        '--compression', type=str, default='zstd', choices=list(COMPRESSIONS.keys()),
+        help='Compression used for saved NetCDF variables'
+    )
+    parser.add_argument(
+        '--digits', type=int, default=None,
+        help='Significant digits kept in saved samples (lossy), full precision if not given'
+    )
+    parser.add_argument(
+        '--archive', type=str, default=None, choices=list(COMPRESSIONS.keys()),
+        help='Recompress the saved file with this compression once recording stops, e.g. after recording with --compression none'
+    )
+    return parser
+
+
+def start_tcp_client(args: argparse.Namespace) -> Tuple[Queue, int]:
+    # Start receiving on a background thread, returns the snapshot queue
+    # and the window size in ms
+    winsize = args.window*1000
+    if winsize < 1000:
+        print(f"Window size {winsize} ms is too small, setting to 1000 ms")
+        winsize = 1000
+    elif winsize > 10000:
+        print(f"Window size {winsize} ms is too large, setting to 10000 ms")
+        winsize = 10000
+    queue = Queue(maxsize=4)  # Older snapshots are dropped when full
+    thread = TcpThread(args.host, args.port, queue, datasize=winsize)
+    thread.daemon = True  # Ensure the thread exits when the main program exits
+    thread.start()
+    print(
+        f"Starting TCP client thread for {args.host}:{args.port} with window size {winsize} ms")
+    return queue, winsize
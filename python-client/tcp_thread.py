@@ -1,38 +1,148 @@
 from __future__ import annotations
-from collections import deque
+from dataclasses import dataclass
 from datetime import datetime
 import socket
 import struct
 from time import perf_counter_ns, sleep
-from typing import Dict
+from typing import Dict, List, Optional
 import numpy as np
-import pandas as pd
-from queue import Queue
+from queue import Empty, Full, Queue
 from threading import Thread
 
+# Wire format of a single accelerometer packet: (id, gap [us], x, y, z)
+PACKET = struct.Struct('<IIfff')
+PACKET_SIZE = PACKET.size
+# Same layout as a numpy record, to decode whole batches at once
+PACKET_DT = np.dtype([
+    ('id', '<u4'), ('gap', '<u4'), ('x', '<f4'), ('y', '<f4'), ('z', '<f4')
+])
+assert PACKET_DT.itemsize == PACKET_SIZE
+BATCH_SIZE = 4096  # Number of packets decoded per receive buffer (80 KiB)
+RCVBUF_SIZE = 12 * 1024 * 1024  # Kernel receive buffer, absorbs plot stalls
 
+
+COLUMNS = ('tstamp', 'x', 'y', 'z', 'dx', 'dy', 'dz')
+
+
+def split_packets(batch: np.ndarray):
+    # Yield (id, packets) for each id in a decoded batch, in order of first
+    # appearance. There are only a few ids, so one mask per id beats sorting
+    # the whole batch with np.unique.
+    ids = batch['id']
+    rest = np.ones(len(ids), dtype=bool)
+    while rest.any():
+        pos = int(np.argmax(rest))
+        id = int(ids[pos])
+        mask = ids == id
+        yield id, batch[mask]
+        rest &= ~mask
+
+
+# Samples of one id, oldest first, as one numpy array per column
+@dataclass
+class SampleBatch:
+    tstamp: np.ndarray
+    x: np.ndarray
+    y: np.ndarray
+    z: np.ndarray
+    dx: np.ndarray
+    dy: np.ndarray
+    dz: np.ndarray
+
+    def __len__(self):
+        return len(self.tstamp)
+
+    def __getitem__(self, index: slice) -> SampleBatch:
+        # Slicing gives views of every column
+        return SampleBatch(*(getattr(self, c)[index] for c in COLUMNS))
+
+    @property
+    def acc(self):
+        return (self.x, self.y, self.z)
+
+    @property
+    def jerk(self):
+        return (self.dx, self.dy, self.dz)
+
+
+# Ring buffer of samples, stored as one numpy array per column
 class DataBuffer:
+    __slots__ = ('_maxlen', '_mask', '_cols', '_head', '_n', '_last_t', '_last_xyz')
+
     def __init__(self, maxlen=2000):
         # Ensure maxlen is a power of 2
-        maxlen = 1 << int(np.ceil(np.log2(maxlen)))
-        self._data = deque(maxlen=maxlen)
-
-    def append(self, item):
-        self._data.append(item)
+        maxlen = 1 if maxlen <= 1 else 1 << (maxlen - 1).bit_length()
+        self._maxlen = maxlen
+        self._mask = maxlen - 1
+        # Timestamps are kept in double precision, the rest match the wire
+        self._cols = [
+            np.empty(maxlen, dtype=np.float64 if col == 'tstamp' else np.float32)
+            for col in COLUMNS
+        ]
+        self._head = 0  # Next slot to be written
+        self._n = 0  # Number of valid samples
+        # Last sample, kept as scalars to continue from on the next batch
+        self._last_t = 0.0
+        self._last_xyz = (np.nan, np.nan, np.nan)
 
-    def clear(self):
-        self._data.clear()
+    def extend(self, items):
+        # Bulk append of one array per column, wrapping around as needed
+        n = len(items[0])
+        if n > self._maxlen:
+            items = [val[-self._maxlen:] for val in items]
+            n = self._maxlen
+        head = self._head
+        first = min(n, self._maxlen - head)
+        for col, val in zip(self._cols, items):
+            col[head:head + first] = val[:first]
+            col[:n - first] = val[first:]
+        self._head = (head + n) & self._mask
+        self._n = min(self._n + n, self._maxlen)
+        if n > 0:
+            self._last_t = float(items[0][-1])
+            self._last_xyz = (
+                float(items[1][-1]), float(items[2][-1]), float(items[3][-1]))
 
-    def __getitem__(self, index):
-        return self._data[index]
+    def ingest(self, gap, x, y, z):
+        # Append raw samples given the gap (s) to the previous sample each.
+        # Timestamps are accumulated in double precision so they don't drift.
+        tstamp = self._last_t + np.cumsum(gap, dtype=np.float64)
+        # The derivatives stay in single precision like the samples, instead
+        # of being widened to float64 and narrowed again when stored
+        # One division for the inverse gap, shared by all three axes. The
+        # first sample of a stream has no gap, its derivative is NaN anyway.
+        with np.errstate(divide='ignore'):
+            inv_gap = np.float32(1) / gap.astype(np.float32)
+        (x0, y0, z0) = self._last_xyz
+        self.extend((
+            tstamp, x, y, z,
+            np.diff(x, prepend=np.float32(x0)) * inv_gap,
+            np.diff(y, prepend=np.float32(y0)) * inv_gap,
+            np.diff(z, prepend=np.float32(z0)) * inv_gap,
+        ))
 
     def __len__(self):
-        return len(self._data)
+        return self._n
 
-    def to_dataframe(self, columns=None):
-        if columns is None:
-            columns = ['tstamp', 'x', 'y', 'z', 'dx', 'dy', 'dz']
-        return pd.DataFrame(list(self._data), columns=columns)
+    def snapshot(self) -> SampleBatch:
+        # Copy out the valid samples, oldest first. The arrays are copied
+        # since the receiving thread keeps writing into the buffer.
+        if self._n < self._maxlen:
+            return SampleBatch(*(a[:self._n].copy() for a in self._cols))
+        head = self._head
+        return SampleBatch(*(np.concatenate((a[head:], a[:head])) for a in self._cols))
+
+
+def latest(queue: Queue):
+    # Newest item on the queue without blocking, or None if it is empty.
+    # Older items are skipped, the consumers only show the newest data.
+    get_nowait = queue.get_nowait
+    item = None
+    while True:
+        try:
+            item = get_nowait()
+        except Empty:
+            return item
 
 
 class DataRate:
@@ -43,10 +153,12 @@ class DataRate:
         self.update_rate = update_rate
         self.start = perf_counter_ns()
 
-    def update(self, num_samples: int = 1):
-        now = perf_counter_ns()
+    def update(self, num_samples: int = 1, num_packets: int = 1, now: Optional[int] = None):
+        # Callers that already read the clock for this batch pass it in
+        if now is None:
+            now = perf_counter_ns()
         self.bytecount += num_samples
-        self.count += 1
+        self.count += num_packets
         if self.last is None:
             self.last = now
             return
@@ -80,15 +192,62 @@ class TcpThread(Thread):
         self.queue = queue
         self.running = True
         self.datasize = datasize
+        # Use DataBuffer for efficient data handling
+        self._ids: List[int] = []
+        self._datasets: Dict[int, DataBuffer] = dict()
+        self._packets: Dict[int, int] = dict()  # For debugging purposes
+        self._last = perf_counter_ns()  # Time of the last published snapshots
+
+    def publish(self, snapshots):
+        # Consumers only show the newest data, so when a bounded queue is
+        # full drop the oldest entry instead of blocking or growing
+        try:
+            self.queue.put_nowait(snapshots)
+        except Full:
+            try:
+                self.queue.get_nowait()
+            except Empty:
+                pass
+            self.queue.put_nowait(snapshots)
+
+    def _ingest(self, batch: np.ndarray):
+        # Append a decoded batch to the buffer of each id in it. A bad batch
+        # is skipped, it must not end the session.
+        try:
+            for (id, rows) in split_packets(batch):
+                if id not in self._datasets:
+                    (_, gap, x, y, z) = rows[0].tolist()
+                    gap *= 1e-6  # Convert gap to seconds
+                    print(f"Creating new DataBuffer: {id}, {gap}, {x}, {y}, {z}")
+                    self._ids.append(id)
+                    self._datasets[id] = DataBuffer(maxlen=self.datasize)
+                    self._packets[id] = 0
+                # Convert gap to seconds
+                self._datasets[id].ingest(
+                    rows['gap'] * 1e-6, rows['x'], rows['y'], rows['z'])
+                self._packets[id] += len(rows)
+        except Exception as e:
+            print(f"Error processing data: {e!r}, {len(batch)} packets")
+
+    def _maybe_publish(self, now: int):
+        if now - self._last > 100e6:  # If more than 100 ms since last update
+            self._last = now
+            # Pair each snapshot with the number of samples received
+            snapshots = [
+                (id, self._packets[id], self._datasets[id].snapshot())
+                for id in self._ids if len(self._datasets[id]) > 0
+            ]
+            if len(snapshots) > 0:
+                self.publish(snapshots)
 
     def run(self):
-        # Use DataBuffer for efficient data handling
-        ids = []
-        datasets: Dict[int, DataBuffer] = dict()
-        packets: Dict[int, int] = dict()  # For debugging purposes
         datarate = DataRate(update_rate=1.0)
         while True:
             client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # Set before connecting so the larger TCP window gets negotiated
+            client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RCVBUF_SIZE)
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
             try:
                 client.connect((self.host, self.port))
             except Exception as e:
@@ -97,36 +256,29 @@ class TcpThread(Thread):
             break
             
         print(f"Connected to {self.host}:{self.port}")
-        last = perf_counter_ns()
+        self._last = perf_counter_ns()
+        buf = bytearray(BATCH_SIZE * PACKET_SIZE)
+        mv = memoryview(buf)
+        off = 0  # Number of valid bytes in buf
         while True:
-            now = perf_counter_ns()
             try:
-                bytes = client.recv(20)
-                datarate.update(len(bytes))
-                (id, gap, x, y, z) = struct.unpack('<IIfff', bytes)
-                gap *= 1e-6 # Convert gap to seconds
-                if id not in datasets:
-                    print(f"Creating new DataBuffer: {id}, {gap}, {x}, {y}, {z}")
-                    ids.append(id)
-                    datasets[id] = DataBuffer(maxlen=self.datasize)
-                    datasets[id].append((gap, x, y, z, np.nan, np.nan, np.nan))
-                    packets[id] = 1
-                else:
-                    tstamp, x0, y0, z0, _, _, _ = datasets[id][-1]
-                    tstamp += gap
-                    dx = (x - x0) / gap
-                    dy = (y - y0) / gap
-                    dz = (z - z0) / gap
-                    datasets[id].append((tstamp, x, y, z, dx, dy, dz))
-                    packets[id] += 1
-                    if now - last > 100e6:  # If more than 100 ms since last update
-                        last = now
-                        dataframes = [(id, datasets[id].to_dataframe()) for id in ids if len(datasets[id]) > 0]
-                        if len(dataframes) > 0:
-                            self.queue.put_nowait(dataframes)
-            except struct.error as e:
-                print(f"Error unpacking data: {e}, received data: {bytes}") # type: ignore
-                continue
+                nbytes = client.recv_into(mv[off:])
+                now = perf_counter_ns()  # One clock read per received batch
+                if nbytes == 0:
+                    print("Connection closed by server")
+                    client.close()
+                    break
+                off += nbytes
+                count = off // PACKET_SIZE
+                datarate.update(nbytes, count, now)
+                if count == 0:
+                    continue
+                self._ingest(np.frombuffer(buf, dtype=PACKET_DT, count=count))
+                # Keep the trailing partial packet for the next receive
+                used = count * PACKET_SIZE
+                mv[:off - used] = mv[used:off]
+                off -= used
+                self._maybe_publish(now)
             except Exception as e:
                 print(f"Error: {e}")
                 client.close()
@@ -135,4 +287,3 @@ class TcpThread(Thread):
                 print("Interrupted by user")
                 client.close()
                 break
-
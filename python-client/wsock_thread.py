@@ -0,0 +1,65 @@
+from __future__ import annotations
+from operator import itemgetter
+from time import perf_counter_ns, sleep
+import numpy as np
+from websockets.sync.client import connect
+try:
+    # orjson is considerably faster for the per-frame decode, but optional
+    from orjson import loads, JSONDecodeError
+except ImportError:
+    from json import loads, JSONDecodeError
+from tcp_thread import PACKET_DT, PACKET_SIZE, DataRate, TcpThread
+
+FIELDS = itemgetter('idx', 'gap', 'x', 'y', 'z')
+
+
+# Same snapshots as TcpThread, received over a WebSocket instead
+class WsockThread(TcpThread):
+    def run(self):
+        datarate = DataRate(update_rate=1.0)
+        while True:
+            try:
+                client = connect(f"ws://{self.host}:{self.port}")
+            except Exception as e:
+                sleep(0.1)
+                continue
+            break
+
+        print(f"Connected to {self.host}:{self.port}")
+        self._last = perf_counter_ns()
+        while True:
+            try:
+                data = client.recv()
+                now = perf_counter_ns()
+                batch = None
+                if isinstance(data, bytes):
+                    # Binary frames carry packed packets, same layout as the TCP stream
+                    if len(data) % PACKET_SIZE:
+                        print(f"Received truncated binary frame: {len(data)} bytes")
+                        continue
+                    batch = np.frombuffer(data, dtype=PACKET_DT)
+                elif isinstance(data, str):
+                    try:
+                        datas = loads(data)
+                    except JSONDecodeError:
+                        print(f"Received non-JSON data: {data}")
+                        continue
+                    try:
+                        batch = np.array(list(map(FIELDS, datas)), dtype=PACKET_DT)
+                    except (KeyError, TypeError, ValueError, OverflowError) as e:
+                        # Missing keys, records that are not sample dicts or
+                        # values that don't fit the packet fields
+                        print(f"Malformed data: {e!r}, {datas}")
+                        continue
+                if batch is not None:
+                    datarate.update(len(data), len(batch), now)
+                    self._ingest(batch)
+                self._maybe_publish(now)
+            except Exception as e:
+                print(f"Error: {e}")
+                client.close()
+                break
+            except KeyboardInterrupt:
+                print("Interrupted by user")
+                client.close()
+                break